@@ -1,28 +1,166 @@
+import asyncio
+import collections
 import os
 import json
+import logging
+import random
 import time
 import subprocess
-import platform
+import re
 import socket
 import sys
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import ipaddress
+import shutil
+import threading
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 import uuid
 
-import requests
+# Mensagens formatadas só se o nível estiver habilitado (AGENT_LOG_LEVEL); configurado em main()
+logger = logging.getLogger("agent")
+vlc_logger = logging.getLogger("vlc")
+
+# Desligado se o processo não tiver permissão para abrir socket ICMP
+_ICMPLIB_PING_OK = True
+
+_IS_WINDOWS = sys.platform.startswith("win")
+
+# Sessões HTTP (keep-alive): reaproveitam a conexão TCP/TLS com o servidor entre chamadas e ciclos.
+# Criadas em _get_session() para não pagar o import de requests (urllib3, ssl, ...) na partida.
+# Chave: com retry (chamadas à API do servidor) ou sem (sonda de conectividade e speedtests).
+_SESSIONS: Dict[bool, Any] = {}
 
 DEFAULT_INTERVAL = 5
 AGENT_VERSION = "1.3"  # Incrementar a cada atualização
 
+# Cache da tabela ARP: ip -> (mac, instante da leitura em time.monotonic())
+_ARP_CACHE_TTL_SEC = 30
+_ARP_CACHE: Dict[str, Tuple[str, float]] = {}
+# None = tabela nunca lida (monotonic() conta desde o boot: 0.0 pareceria "recente" logo após ligar)
+_ARP_TABLE_TS: Optional[float] = None
+# Prefixos /24 já varridos: prefixo -> time.monotonic() do sweep. Dentro de _ARP_CACHE_TTL_SEC
+# o resultado do sweep (tabela ARP em cache) serve para qualquer MAC procurado nessa rede.
+_SWEPT_PREFIXES: Dict[str, float] = {}
+# Threads do executor de cada ciclo do run_once (config, rede, speedtests e câmeras em paralelo)
+_CYCLE_EXECUTOR_WORKERS = 16
+# Chaves do agent_state.json que versões anteriores gravavam e não são mais usadas
+_LEGACY_STATE_KEYS = ("mac_cache",)
+# Relatórios não entregues guardados no estado para reenvio (os mais antigos são descartados)
+_MAX_PENDING_REPORTS = 200
+# Respostas 4xx que são temporárias (timeout/limite de taxa): tratadas como 5xx, não como recusa
+_TRANSIENT_HTTP_STATUSES = frozenset({408, 429})
+# Redes privadas (RFC 1918): únicas em que o agente faz sweep ICMP
+_PRIVATE_NETS = tuple(ipaddress.ip_network(n) for n in ("10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16"))
+# Máximo de pings simultâneos no sweep via subprocesso (sem permissão de socket ICMP)
+_SWEEP_MAX_CONCURRENCY = 128
+
+# Câmera normalizada uma vez por ciclo (config do servidor ou local); só entradas com ip
+Cam = collections.namedtuple("Cam", "name ip nvr_password")
+
+# Caches de arquivos locais, invalidados pela mudança de mtime/tamanho do arquivo
+_CFG_CACHE: Optional[Tuple[Optional[int], Dict[str, Any]]] = None
+_STATE_CACHE: Optional[Tuple[Tuple[int, int], Dict[str, Any]]] = None
+# Hash do último conteúdo gravado em agent_state.json (para pular gravações sem mudança)
+_STATE_HASH: Optional[bytes] = None
+
+# Config vinda do servidor muda raramente: cache por (server, site) -> (time.monotonic(), config)
+_SERVER_CFG_TTL_SEC = 60
+_SERVER_CFG_CACHE: Dict[Tuple[str, str], Tuple[float, Dict[str, Any]]] = {}
+
+# Regexes compiladas uma única vez (usadas em loops por linha de saída de subprocessos)
+_RE_WIN_AVG = re.compile(r"(\d+)\s*ms", re.IGNORECASE)
+_RE_LOSS = re.compile(r"\((\d+)\s*%")
+# Linux: "bytes from" | Windows PT: "Resposta de" | Windows EN: "Reply from" | TTL presente indica resposta
+_RE_SUCCESS = re.compile(r"bytes?\s+from|resposta\s+de|reply\s+from|ttl\s*=", re.IGNORECASE)
+# AA:BB:CC:DD:EE:FF ou AA-BB-CC-DD-EE-FF ou AABBCCDDEEFF
+_RE_MAC = re.compile(r"(?:[0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}|[0-9A-Fa-f]{12}")
+_RE_ARP_IP = re.compile(r"\s*(\d{1,3}(?:\.\d{1,3}){3})\s")
+_RE_VLC_ERROR = re.compile(
+    r"connection failed|cannot connect|401 unauthorized|404 not found|timeout|no suitable decoder",
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _icmplib():
+    """icmplib (opcional), importado no primeiro ping. None se não estiver instalado."""
+    try:
+        import icmplib  # type: ignore
+    except ImportError:
+        return None
+    return icmplib
+
+
+@functools.lru_cache(maxsize=1)
+def _orjson():
+    """orjson (opcional), importado na primeira serialização. None se não estiver instalado."""
+    try:
+        import orjson  # type: ignore
+    except ImportError:
+        return None
+    return orjson
+
 
-def load_agent_config() -> Dict[str, Any]:
+def _get_session(retry: bool = True):
+    """
+    Sessão compartilhada. retry=True para a API do servidor; retry=False para medições
+    (sonda HTTP, speedtests), em que tentativas e backoff estourariam o tempo limite
+    da sonda e entrariam na cronometragem.
+    """
+    session = _SESSIONS.get(retry)
+    if session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Retry só cobre falhas de conexão e métodos idempotentes (POST não é
+        # repetido por padrão): relatórios não enviados já ficam em pending_reports.
+        max_retries = Retry(total=3, backoff_factor=0.5) if retry else 0
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=max_retries))
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=max_retries))
+        _SESSIONS[retry] = session
+    return session
+
+
+def _dumps(obj: Any, pretty: bool = False) -> bytes:
+    """Serializa para JSON UTF-8. Usa orjson (C) se instalado; senão json compacto da stdlib."""
+    orjson = _orjson()
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def load_agent_config(strict: bool = False) -> Dict[str, Any]:
+    """Lê agent.json + variáveis de ambiente. Só re-parseia se o arquivo mudou (mtime).
+    Com strict=True, agent.json ilegível (ex.: gravação pela metade) ou removido depois de
+    já ter sido lido levanta exceção em vez de virar config padrão, para o chamador manter
+    a config anterior.
+    """
+    global _CFG_CACHE
     cfg_path = Path(__file__).parent / "agent.json"
+    try:
+        mtime: Optional[int] = cfg_path.stat().st_mtime_ns
+    except OSError:
+        mtime = None
+    if _CFG_CACHE is not None and _CFG_CACHE[0] == mtime:
+        return dict(_CFG_CACHE[1])
+    if strict and mtime is None and _CFG_CACHE is not None and _CFG_CACHE[0] is not None:
+        raise FileNotFoundError(f"{cfg_path} não encontrado")
     cfg: Dict[str, Any] = {}
-    if cfg_path.exists():
+    if mtime is not None:
         try:
             cfg = json.loads(cfg_path.read_text(encoding="utf-8"))
         except Exception:
+            if strict:
+                raise
             cfg = {}
     # Env overrides
     server = os.getenv("AGENT_SERVER", cfg.get("server", "http://localhost:9000"))
@@ -40,7 +178,7 @@ def load_agent_config() -> Dict[str, Any]:
         speed_ul = int(os.getenv("AGENT_SPEEDTEST_UPLOAD_BYTES", str(cfg.get("speed_upload_bytes", 512 * 1024))))
     except Exception:
         speed_ul = 512 * 1024
-    return {
+    result = {
         "server": server.rstrip("/"),
         "token": token,
         "interval_sec": interval_sec,
@@ -50,6 +188,8 @@ def load_agent_config() -> Dict[str, Any]:
         "speed_download_bytes": speed_dl,
         "speed_upload_bytes": speed_ul,
     }
+    _CFG_CACHE = (mtime, result)
+    return dict(result)
 
 
 def test_camera_nvr_stream(ip: str, nvr_password: str, timeout_sec: int = 10) -> Tuple[bool, Optional[str]]:
@@ -66,8 +206,6 @@ def test_camera_nvr_stream(ip: str, nvr_password: str, timeout_sec: int = 10) ->
         - success: True se conseguiu stream, False caso contrário
         - error_message: Mensagem de erro ou None se sucesso
     """
-    import re as _re
-    
     # URL RTSP padrão para NVRs (ajustar conforme seu modelo)
     # Formatos comuns:
     # rtsp://admin:senha@IP:554/onvif1 (ONVIF - mais compatível)
@@ -77,11 +215,10 @@ def test_camera_nvr_stream(ip: str, nvr_password: str, timeout_sec: int = 10) ->
     
     # Tentar com VLC (cvlc = VLC sem interface)
     # No Windows, VLC pode estar em caminhos específicos
-    is_windows = platform.system().lower().startswith("win")
     
     vlc_commands = []
     
-    if is_windows:
+    if _IS_WINDOWS:
         # Caminhos comuns do VLC no Windows
         possible_paths = [
             r"C:\Program Files\VideoLAN\VLC\vlc.exe",
@@ -99,7 +236,7 @@ def test_camera_nvr_stream(ip: str, nvr_password: str, timeout_sec: int = 10) ->
     
     for cmd in vlc_commands:
         try:
-            print(f"[vlc] Trying command: {cmd[0]}")
+            vlc_logger.debug("Trying command: %s", cmd[0])
             proc = subprocess.run(
                 cmd,
                 capture_output=True,
@@ -108,52 +245,42 @@ def test_camera_nvr_stream(ip: str, nvr_password: str, timeout_sec: int = 10) ->
             )
             
             output = (proc.stdout or "") + (proc.stderr or "")
-            print(f"[vlc] Return code: {proc.returncode}")
+            vlc_logger.debug("Return code: %s", proc.returncode)
             
             # VLC retorna 0 se conseguiu abrir o stream
             # Verificar também por mensagens de erro conhecidas
-            error_patterns = [
-                r"connection failed",
-                r"cannot connect",
-                r"401 unauthorized",
-                r"404 not found",
-                r"timeout",
-                r"no suitable decoder",
-            ]
-            
-            has_error = any(_re.search(pattern, output, _re.IGNORECASE) for pattern in error_patterns)
+            has_error = _RE_VLC_ERROR.search(output) is not None
             
             if proc.returncode == 0 and not has_error:
-                print(f"[vlc] SUCCESS: Stream accessible")
+                vlc_logger.info("SUCCESS: Stream accessible")
                 return True, None
             elif has_error:
                 # Extrair mensagem de erro
                 for line in output.splitlines():
-                    for pattern in error_patterns:
-                        if _re.search(pattern, line, _re.IGNORECASE):
-                            print(f"[vlc] ERROR detected: {line.strip()[:200]}")
-                            return False, line.strip()[:200]
-                print(f"[vlc] ERROR: Stream error detected")
+                    if _RE_VLC_ERROR.search(line):
+                        vlc_logger.warning("ERROR detected: %s", line.strip()[:200])
+                        return False, line.strip()[:200]
+                vlc_logger.warning("ERROR: Stream error detected")
                 return False, "Stream error detected"
             else:
-                print(f"[vlc] Non-zero return code but no error pattern matched, trying next command...")
+                vlc_logger.debug("Non-zero return code but no error pattern matched, trying next command...")
             
         except subprocess.TimeoutExpired:
-            print(f"[vlc] TIMEOUT after {timeout_sec}s")
+            vlc_logger.warning("TIMEOUT after %ss", timeout_sec)
             return False, f"Timeout após {timeout_sec}s"
         except FileNotFoundError:
-            print(f"[vlc] Command not found: {cmd[0]}, trying next...")
+            vlc_logger.debug("Command not found: %s, trying next...", cmd[0])
             # VLC não encontrado, tentar próximo comando
             continue
         except Exception as e:
-            print(f"[vlc] EXCEPTION: {str(e)}")
+            vlc_logger.error("EXCEPTION: %s", e)
             return False, f"Error: {str(e)}"
     
     # Se chegou aqui, VLC não está instalado
     return False, "VLC not installed. Install with: apt install vlc (Linux) or download from videolan.org (Windows)"
 
 
-def ping_ip(ip: str, count: int = 6, timeout_ms: int = 3000, retry: int = 3) -> Tuple[bool, Optional[float], Optional[float], str]:
+def ping_ip(ip: str, count: int = 6, timeout_ms: int = 3000, retry: int = 3, parse_stats: bool = True) -> Tuple[bool, Optional[float], Optional[float], str]:
     """
     Retorna: (reachable, avg_latency_ms, packet_loss_percent, raw_output_tail)
     
@@ -164,11 +291,61 @@ def ping_ip(ip: str, count: int = 6, timeout_ms: int = 3000, retry: int = 3) ->
     - Timeout aumentado para 3000ms para câmeras Yoosee que demoram mais
     - 6 pings por tentativa para maior confiabilidade
     - 3 tentativas de retry para reduzir falsos negativos
+    - Usa icmplib (ICMP no próprio processo, sem subprocesso nem parsing de texto)
+      quando disponível; senão, o comando `ping` do sistema
+    - parse_stats=False: só alcançabilidade (código de saída do ping, sem capturar/parsear a saída);
+      latência e perda voltam None
     """
-    import re as _re
+    global _ICMPLIB_PING_OK
+    icmplib = _icmplib() if _ICMPLIB_PING_OK else None
+    if icmplib is not None:
+        try:
+            return _ping_ip_icmplib(icmplib, ip, count, timeout_ms, retry)
+        except icmplib.SocketPermissionError as e:
+            # Sem permissão para abrir socket ICMP: usar o ping do sistema daqui em diante
+            logger.warning("icmplib ping unavailable (%s), using system ping", e)
+            _ICMPLIB_PING_OK = False
+        except Exception as e:
+            logger.warning("icmplib ping error for %s: %s", ip, e)
+    if not parse_stats:
+        return _ping_ip_reachable(ip, count, timeout_ms, retry)
+    return _ping_ip_subprocess(ip, count, timeout_ms, retry)
+
+
+def _ping_ip_icmplib(icmplib: Any, ip: str, count: int, timeout_ms: int, retry: int) -> Tuple[bool, Optional[float], Optional[float], str]:
+    last_error = None
+    for attempt in range(retry):
+        host = icmplib.ping(ip, count=count, timeout=timeout_ms / 1000, privileged=False)
+        if host.is_alive:
+            return True, host.avg_rtt or None, host.packet_loss * 100, ""
+        last_error = f"{host.packets_sent} sent, {host.packets_received} received"
+        if attempt < retry - 1:
+            time.sleep(0.5)
+    return False, None, None, last_error or "ping failed after retries"
+
+
+def _ping_ip_reachable(ip: str, count: int, timeout_ms: int, retry: int) -> Tuple[bool, Optional[float], Optional[float], str]:
+    if _IS_WINDOWS:
+        cmd = ["ping", "-n", str(count), "-w", str(timeout_ms), ip]
+    else:
+        cmd = ["ping", "-c", str(count), "-W", str(max(1, round(timeout_ms / 1000))), ip]
     
-    is_windows = platform.system().lower().startswith("win")
-    if is_windows:
+    last_error = None
+    for attempt in range(retry):
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=25)
+            if proc.returncode == 0:
+                return True, None, None, ""
+            last_error = f"ping exit {proc.returncode}"
+        except Exception as e:
+            last_error = f"ping error: {e}"
+        if attempt < retry - 1:
+            time.sleep(0.5)
+    return False, None, None, last_error or "ping failed after retries"
+
+
+def _ping_ip_subprocess(ip: str, count: int, timeout_ms: int, retry: int) -> Tuple[bool, Optional[float], Optional[float], str]:
+    if _IS_WINDOWS:
         cmd = ["ping", "-n", str(count), "-w", str(timeout_ms), ip]
     else:
         # -W 3 (segundos no Linux), -c count - aumentado para 3s para câmeras Yoosee
@@ -186,39 +363,42 @@ def ping_ip(ip: str, count: int = 6, timeout_ms: int = 3000, retry: int = 3) ->
             avg_ms: Optional[float] = None
             loss_pct: Optional[float] = None
             
-            if is_windows:
-                # Ex.: Média = 4ms ou Average = 4ms
-                for line in output.splitlines():
-                    line = line.strip()
-                    # Suporta PT e EN
-                    if "média" in line.lower() or "average" in line.lower():
+            has_success = False
+            
+            # Uma única passada pela saída extraindo latência, perda e indício de resposta
+            for line in output.splitlines():
+                if _IS_WINDOWS:
+                    # Ex.: Média = 4ms ou Average = 4ms (suporta PT e EN)
+                    # Perda: "Perdidos = X (Y% perda)" ou "Lost = X (Y% loss)"
+                    low = line.lower()
+                    if avg_ms is None and ("média" in low or "average" in low):
                         # Pegar número antes de 'ms'
-                        m = _re.search(r"(\d+)\s*ms", line, _re.IGNORECASE)
+                        m = _RE_WIN_AVG.search(line)
                         if m:
                             avg_ms = float(m.group(1))
-                
-                # Perda: "Perdidos = X (Y% perda)" ou "Lost = X (Y% loss)"
-                for line in output.splitlines():
-                    if "perdidos" in line.lower() or "lost" in line.lower():
-                        m = _re.search(r"\((\d+)\s*%", line)
+                    elif loss_pct is None and ("perdidos" in low or "lost" in low):
+                        m = _RE_LOSS.search(line)
                         if m:
                             loss_pct = float(m.group(1))
-            else:
-                # Linux/mac output: rtt min/avg/max/mdev = 0.345/0.456/...
-                for line in output.splitlines():
-                    if "rtt min/avg/max" in line or "round-trip min/avg/max" in line:
+                else:
+                    # Linux/mac output: rtt min/avg/max/mdev = 0.345/0.456/...
+                    if avg_ms is None and ("rtt min/avg/max" in line or "round-trip min/avg/max" in line):
                         try:
                             part = line.split("=")[-1].strip().split("/")
                             avg_ms = float(part[1])
                         except Exception:
                             pass
-                
-                for line in output.splitlines():
-                    if "% packet loss" in line:
+                    elif loss_pct is None and "% packet loss" in line:
                         try:
                             loss_pct = float(line.split("% packet loss")[0].split(" ")[-1])
                         except Exception:
                             pass
+                
+                if not has_success and _RE_SUCCESS.search(line):
+                    has_success = True
+                
+                if has_success and avg_ms is not None and loss_pct is not None:
+                    break
             
             # Validação: detectar falsos positivos
             # Se returncode = 0 mas perda >= 100%, considerar offline
@@ -235,13 +415,6 @@ def ping_ip(ip: str, count: int = 6, timeout_ms: int = 3000, retry: int = 3) ->
             # Verificar se há pelo menos uma resposta bem-sucedida no output
             if reachable and avg_ms is None:
                 # Procurar por padrões de resposta bem-sucedida
-                success_patterns = [
-                    r"bytes?\s+from",  # Linux: "bytes from"
-                    r"resposta\s+de",  # Windows PT: "Resposta de"
-                    r"reply\s+from",   # Windows EN: "Reply from"
-                    r"ttl\s*=",        # TTL presente indica resposta
-                ]
-                has_success = any(_re.search(pattern, output, _re.IGNORECASE) for pattern in success_patterns)
                 if not has_success:
                     reachable = False
             
@@ -270,52 +443,137 @@ def get_mac_address(ip: str) -> Optional[str]:
     """
     Obtém o MAC address de um IP usando tabela ARP.
     Retorna MAC no formato AA:BB:CC:DD:EE:FF ou None se não encontrado.
-    """
-    import re as _re
-    
-    is_windows = platform.system().lower().startswith("win")
     
+    A tabela ARP é lida inteira e mantida em cache por _ARP_CACHE_TTL_SEC;
+    dentro desse período as consultas não disparam nenhum subprocesso.
+    """
     try:
-        # Primeiro, fazer ping para popular tabela ARP
-        ping_ip(ip, count=1, timeout_ms=500, retry=1)
-        
-        if is_windows:
-            # Windows: arp -a IP
-            proc = subprocess.run(["arp", "-a", ip], capture_output=True, text=True, timeout=5)
-        else:
-            # Linux/Mac: arp -n IP ou ip neigh show IP
-            proc = subprocess.run(["arp", "-n", ip], capture_output=True, text=True, timeout=5)
-        
-        output = proc.stdout + proc.stderr
-        
-        # Procurar padrão de MAC address (vários formatos)
-        # AA:BB:CC:DD:EE:FF ou AA-BB-CC-DD-EE-FF ou AABBCCDDEEFF
-        mac_patterns = [
-            r"([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})",  # AA:BB:CC:DD:EE:FF ou AA-BB-CC-DD-EE-FF
-            r"([0-9A-Fa-f]{12})",  # AABBCCDDEEFF
-        ]
-        
-        for pattern in mac_patterns:
-            match = _re.search(pattern, output)
-            if match:
-                mac = match.group(0)
-                # Normalizar para formato AA:BB:CC:DD:EE:FF
-                mac = mac.replace("-", ":")
-                if len(mac) == 12:  # AABBCCDDEEFF
-                    mac = ":".join([mac[i:i+2] for i in range(0, 12, 2)])
-                return mac.upper()
-        
-        return None
+        if _arp_cache_stale():
+            # Primeiro, fazer ping para popular tabela ARP
+            ping_ip(ip, count=1, timeout_ms=500, retry=1, parse_stats=False)
+            _refresh_arp_table()
+        return _ARP_CACHE.get(ip, (None, 0.0))[0]
         
     except Exception as e:
-        print(f"[agent] get_mac_address error for {ip}: {e}")
+        logger.warning("get_mac_address error for %s: %s", ip, e)
         return None
 
 
+def _normalize_mac(mac: str) -> str:
+    """Normaliza MAC para o formato AA:BB:CC:DD:EE:FF."""
+    mac = mac.replace("-", ":")
+    if len(mac) == 12:  # AABBCCDDEEFF
+        mac = ":".join([mac[i:i+2] for i in range(0, 12, 2)])
+    return mac.upper()
+
+
+def _read_arp_table() -> Dict[str, str]:
+    """
+    Lê a tabela ARP do sistema inteira de uma vez.
+    Retorna dict ip -> MAC (AA:BB:CC:DD:EE:FF). Entradas incompletas são ignoradas.
+    """
+    if _IS_WINDOWS:
+        commands = [["arp", "-a"]]
+    else:
+        # "ip neigh show" é o padrão no Linux; "arp -n" como fallback (net-tools)
+        commands = [["ip", "neigh", "show"], ["arp", "-n"]]
+
+    output = None
+    for cmd in commands:
+        try:
+            proc = subprocess.run(cmd, capture_output=True, text=True, errors="replace", timeout=5)
+            output = proc.stdout or ""
+            break
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning("ARP table read error (%s): %s", cmd[0], e)
+            return {}
+    if output is None:
+        return {}
+
+    table: Dict[str, str] = {}
+    for line in output.splitlines():
+        ip_match = _RE_ARP_IP.match(line)
+        if not ip_match:
+            continue
+        mac_match = _RE_MAC.search(line)
+        if mac_match:
+            table[ip_match.group(1)] = _normalize_mac(mac_match.group(0))
+    return table
+
+
+def _arp_cache_stale() -> bool:
+    """True se a tabela ARP nunca foi lida ou se o cache passou de _ARP_CACHE_TTL_SEC."""
+    return _ARP_TABLE_TS is None or time.monotonic() - _ARP_TABLE_TS >= _ARP_CACHE_TTL_SEC
+
+
+def _refresh_arp_table() -> None:
+    """Recarrega o cache de ARP a partir da tabela do sistema (um único subprocesso)."""
+    global _ARP_CACHE, _ARP_TABLE_TS
+    now = time.monotonic()
+    _ARP_CACHE = {ip: (mac, now) for ip, mac in _read_arp_table().items()}
+    _ARP_TABLE_TS = now
+
+
+async def _icmp_sweep(prefix: str, timeout_sec: float = 2.0) -> None:
+    """
+    Dispara ICMP echo para prefix1..prefix254 em um único event loop.
+    O objetivo é só popular a tabela ARP do sistema; as respostas não são usadas.
+    Usa icmplib (opcional) quando há permissão para socket ICMP; senão o `ping` do sistema.
+    """
+    global _ICMPLIB_PING_OK
+    addresses = [f"{prefix}{i}" for i in range(1, 255)]
+
+    icmplib = _icmplib() if _ICMPLIB_PING_OK else None
+    if icmplib is not None:
+        try:
+            # Checar a permissão antes: sem ela, async_multiping falharia em cada task
+            icmplib.ICMPv4Socket(privileged=False).close()
+        except icmplib.SocketPermissionError as e:
+            logger.warning("icmplib ping unavailable (%s), using system ping", e)
+            _ICMPLIB_PING_OK = False
+        else:
+            await icmplib.async_multiping(
+                addresses, count=1, timeout=timeout_sec,
+                concurrent_tasks=_SWEEP_MAX_CONCURRENCY, privileged=False,
+            )
+            return
+
+    # Sem icmplib/permissão: pings de um pacote no mesmo event loop (sem thread pool),
+    # no máximo _SWEEP_MAX_CONCURRENCY processos ao mesmo tempo
+    sem = asyncio.Semaphore(_SWEEP_MAX_CONCURRENCY)
+
+    async def _ping_one(ip: str) -> None:
+        # Windows: -w em ms; Linux: -W em segundos (mínimo 1)
+        cmd = ["ping", "-n", "1", "-w", "300", ip] if _IS_WINDOWS else ["ping", "-c", "1", "-W", "1", ip]
+        async with sem:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+                )
+            except Exception:
+                return
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=timeout_sec)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if proc.returncode is None:
+                    try:
+                        proc.kill()
+                    except ProcessLookupError:
+                        pass
+
+    await asyncio.gather(*(_ping_one(ip) for ip in addresses))
+
+
 def scan_network_for_mac(mac: str, network_prefix: str, timeout_sec: int = 30) -> Optional[str]:
     """
     Varre a rede procurando um dispositivo com o MAC address especificado.
     
+    Faz um sweep ICMP assíncrono em toda a /24 e depois lê a tabela ARP uma única vez.
+    
     Args:
         mac: MAC address no formato AA:BB:CC:DD:EE:FF
         network_prefix: Prefixo da rede (ex: "192.168.1.")
@@ -324,66 +582,109 @@ def scan_network_for_mac(mac: str, network_prefix: str, timeout_sec: int = 30) -
     Returns:
         IP encontrado ou None
     """
-    import concurrent.futures
-    import re as _re
+    mac_normalized = _normalize_mac(mac)
     
-    mac_normalized = mac.upper().replace("-", ":")
-    start_time = time.time()
+    # Só varrer redes locais privadas (prefixo inválido ou público não é varrido)
+    if not _is_private(f"{network_prefix}1"):
+        logger.warning("Refusing to scan non-private network prefix %r", network_prefix)
+        return None
     
-    print(f"[agent] Scanning network {network_prefix}0/24 for MAC {mac_normalized}...")
+    # Saída antecipada: se o MAC já está na tabela ARP, não precisa varrer a rede
+    if _arp_cache_stale():
+        _refresh_arp_table()
+    ip = _find_mac_in_arp_cache(mac_normalized, network_prefix)
+    if ip:
+        logger.info("Found MAC %s at %s (ARP cache)", mac_normalized, ip)
+        return ip
     
-    def check_ip(suffix: int) -> Optional[str]:
-        """Verifica se um IP específico tem o MAC procurado"""
-        if time.time() - start_time > timeout_sec:
-            return None
-        
-        ip = f"{network_prefix}{suffix}"
-        found_mac = get_mac_address(ip)
-        
-        if found_mac and found_mac.upper() == mac_normalized:
-            print(f"[agent] Found MAC {mac_normalized} at {ip}")
-            return ip
-        
+    # Vários dispositivos da mesma /24 offline no mesmo ciclo: um sweep só
+    swept_at = _SWEPT_PREFIXES.get(network_prefix)
+    if swept_at is not None and time.monotonic() - swept_at < _ARP_CACHE_TTL_SEC:
+        logger.info("MAC %s not found in network %s0/24 (swept %.0fs ago)", mac_normalized, network_prefix, time.monotonic() - swept_at)
         return None
     
-    # Scan paralelo para ser mais rápido (máx 20 threads)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-        # Varrer IPs de 1 a 254
-        futures = {executor.submit(check_ip, i): i for i in range(1, 255)}
-        
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                result = future.result()
-                if result:
-                    # Cancelar outras tarefas
-                    for f in futures:
-                        f.cancel()
-                    return result
-            except Exception:
-                pass
+    logger.info("Scanning network %s0/24 for MAC %s...", network_prefix, mac_normalized)
     
-    print(f"[agent] MAC {mac_normalized} not found in network {network_prefix}0/24")
+    try:
+        asyncio.run(asyncio.wait_for(_icmp_sweep(network_prefix, timeout_sec=min(2.0, timeout_sec)), timeout_sec))
+    except asyncio.TimeoutError:
+        pass
+    except Exception as e:
+        logger.error("ICMP sweep error: %s", e)
+    
+    _refresh_arp_table()
+    _SWEPT_PREFIXES[network_prefix] = _ARP_TABLE_TS
+    ip = _find_mac_in_arp_cache(mac_normalized, network_prefix)
+    if ip:
+        logger.info("Found MAC %s at %s", mac_normalized, ip)
+        return ip
+    
+    logger.info("MAC %s not found in network %s0/24", mac_normalized, network_prefix)
     return None
 
 
-def test_network() -> Dict[str, Any]:
-    net: Dict[str, Any] = {}
-    reachable_1, avg1, _, _ = ping_ip("1.1.1.1", count=4)
-    reachable_8, avg8, _, _ = ping_ip("8.8.8.8", count=4)
-    net["ping_1_1_1_1_ms"] = avg1 if reachable_1 else None
-    net["ping_8_8_8_8_ms"] = avg8 if reachable_8 else None
-    # DNS
+@functools.lru_cache(maxsize=1024)
+def _is_private(ip: str) -> bool:
     try:
-        socket.gethostbyname("google.com")
-        net["dns_ok"] = True
-    except Exception:
-        net["dns_ok"] = False
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(addr in net for net in _PRIVATE_NETS)
+
+
+def _find_mac_in_arp_cache(mac_normalized: str, network_prefix: str) -> Optional[str]:
+    for ip, (found_mac, _) in _ARP_CACHE.items():
+        if found_mac == mac_normalized and ip.startswith(network_prefix):
+            return ip
+    return None
+
+
+def _run_in_daemon_thread(fn: Any, *args: Any) -> concurrent.futures.Future:
+    """Executa fn(*args) numa thread daemon avulsa; uma chamada presa não segura o fim do ciclo."""
+    fut: concurrent.futures.Future = concurrent.futures.Future()
+
+    def _target() -> None:
+        if not fut.set_running_or_notify_cancel():
+            return
+        try:
+            fut.set_result(fn(*args))
+        except BaseException as e:
+            fut.set_exception(e)
+
+    threading.Thread(target=_target, daemon=True).start()
+    return fut
+
+
+async def test_network() -> Dict[str, Any]:
+    """Executa pings, DNS e HTTP em paralelo; o tempo total é o da sonda mais lenta."""
+    loop = asyncio.get_running_loop()
+
+    async def _dns() -> bool:
+        # getaddrinfo bloqueia pelo timeout do resolver (~5s+); limitar a 2s. Roda numa thread
+        # própria: no executor do ciclo, asyncio.run() esperaria a consulta terminar mesmo assim.
+        lookup = _run_in_daemon_thread(socket.getaddrinfo, "google.com", None)
+        await asyncio.wait_for(asyncio.wrap_future(lookup), 2)
+        return True
+
+    def _http() -> bool:
+        _get_session(retry=False).get("https://www.google.com", timeout=5)
+        return True
+
+    ping1, ping8, dns, http = await asyncio.gather(
+        loop.run_in_executor(None, lambda: ping_ip("1.1.1.1", count=4)),
+        loop.run_in_executor(None, lambda: ping_ip("8.8.8.8", count=4)),
+        _dns(),
+        loop.run_in_executor(None, _http),
+        return_exceptions=True,
+    )
+
+    net: Dict[str, Any] = {}
+    net["ping_1_1_1_1_ms"] = ping1[1] if not isinstance(ping1, BaseException) and ping1[0] else None
+    net["ping_8_8_8_8_ms"] = ping8[1] if not isinstance(ping8, BaseException) and ping8[0] else None
     # HTTP
-    try:
-        requests.get("https://www.google.com", timeout=5)
-        net["http_ok"] = True
-    except Exception:
-        net["http_ok"] = False
+    net["http_ok"] = http is True
+    # DNS: se o GET para www.google.com funcionou, a resolução de nomes funciona
+    net["dns_ok"] = dns is True or net["http_ok"]
     return net
 
 
@@ -593,6 +894,28 @@ def internet_speedtest() -> Dict[str, Any]:
 
 
 
+_UPLOAD_CHUNK = bytes(64 * 1024)
+
+
+class _ZeroUpload:
+    """Corpo de upload com `size` bytes zerados, entregue em blocos de _UPLOAD_CHUNK.
+    Expõe __len__ para o requests enviar Content-Length (e não Transfer-Encoding: chunked).
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        n_chunks, tail = divmod(self.size, len(_UPLOAD_CHUNK))
+        for _ in range(n_chunks):
+            yield _UPLOAD_CHUNK
+        if tail:
+            yield _UPLOAD_CHUNK[:tail]
+
+
 def speedtest(server: str, download_bytes: int, upload_bytes: int, token: Optional[str]) -> Dict[str, Any]:
     """Measure download/upload throughput using API endpoints provided by the server.
     Returns: { download_mbps, upload_mbps }
@@ -612,18 +935,22 @@ def speedtest(server: str, download_bytes: int, upload_bytes: int, token: Option
     # Download test - com melhorias de precisão
     try:
         url_dl = f"{server}/api/speedtest/download?size_bytes={max(1, int(download_bytes))}"
-        r = requests.get(url_dl, headers=headers, stream=True, timeout=30)
+        r = _get_session(retry=False).get(url_dl, headers=headers, stream=True, timeout=30)
         r.raise_for_status()
+        r.raw.decode_content = True
         
         total = 0
         chunk_count = 0
         warmup_chunks = 2  # Descartar primeiros chunks (conexão inicial)
         t0 = None
         
-        # Usar chunks maiores para reduzir overhead de processamento
-        for chunk in r.iter_content(chunk_size=256 * 1024):
-            if not chunk:
-                continue
+        # Ler direto num buffer pré-alocado (256 KiB): nenhum objeto bytes por chunk
+        buf = bytearray(256 * 1024)
+        mv = memoryview(buf)
+        while True:
+            n = r.raw.readinto(mv)
+            if not n:
+                break
             
             chunk_count += 1
             
@@ -633,7 +960,7 @@ def speedtest(server: str, download_bytes: int, upload_bytes: int, token: Option
             
             # Contar apenas após warm-up
             if chunk_count > warmup_chunks:
-                total += len(chunk)
+                total += n
         
         if t0 is not None and total > 0:
             dt = time.perf_counter() - t0
@@ -644,16 +971,17 @@ def speedtest(server: str, download_bytes: int, upload_bytes: int, token: Option
             out["download_error"] = "Insufficient data received"
     except Exception as e:
         out["download_error"] = str(e)
-        print(f"[agent] speedtest download error: {e}")
+        logger.error("speedtest download error: %s", e)
 
     # Upload test - com melhorias de precisão
     try:
         url_ul = f"{server}/api/speedtest/upload"
-        payload = b"\x00" * max(1, int(upload_bytes))
+        # Corpo gerado em blocos de 64 KiB em vez de alocar upload_bytes inteiros na memória
+        payload = _ZeroUpload(max(1, int(upload_bytes)))
         
         # Medir tempo de upload mais precisamente
         t0 = time.perf_counter()
-        r = requests.post(url_ul, headers=headers, data=payload, timeout=30)
+        r = _get_session(retry=False).post(url_ul, headers=headers, data=payload, timeout=30)
         dt = time.perf_counter() - t0
         
         r.raise_for_status()
@@ -678,12 +1006,15 @@ def speedtest(server: str, download_bytes: int, upload_bytes: int, token: Option
         out["upload_bytes"] = sent
     except Exception as e:
         out["upload_error"] = str(e)
-        print(f"[agent] speedtest upload error: {e}")
+        logger.error("speedtest upload error: %s", e)
 
     return out
 
 
+@functools.lru_cache(maxsize=1)
 def get_host_name() -> str:
+    import platform
+
     return platform.node() or os.getenv("COMPUTERNAME", "unknown-host")
 
 
@@ -695,57 +1026,73 @@ def check_and_update(server: str, token: Optional[str]) -> bool:
         headers = {"X-Agent-Token": token} if token else {}
         url = f"{server}/api/agent/version"
         
+        # Requisição condicional: validadores guardados da última resposta "sem atualização"
+        # (só valem para a versão que os gravou; após update/downgrade manual, consulta completa)
+        state = _load_state()
+        version_headers = dict(headers)
+        if state.get("update_agent_version") == AGENT_VERSION:
+            if state.get("update_etag"):
+                version_headers["If-None-Match"] = state["update_etag"]
+            if state.get("update_last_modified"):
+                version_headers["If-Modified-Since"] = state["update_last_modified"]
+        
         # Verificar versão disponível no servidor
-        r = requests.get(url, headers=headers, timeout=10)
-        if not r.ok:
+        r = _get_session().get(url, headers=version_headers, timeout=10)
+        if r.status_code == 304 or not r.ok:
             return False
         
         data = r.json()
         server_version = str(data.get("version", "")).strip()
         
         if not server_version or server_version == AGENT_VERSION:
+            # Guardar validadores só aqui: se o download falhar, a próxima verificação
+            # não pode receber 304 e deixar de tentar de novo.
+            state["update_agent_version"] = AGENT_VERSION
+            state["update_etag"] = r.headers.get("ETag")
+            state["update_last_modified"] = r.headers.get("Last-Modified")
+            _save_state(state)
             return False
         
-        print(f"[agent] Nova versão disponível: {server_version} (atual: {AGENT_VERSION})")
+        logger.info("Nova versão disponível: %s (atual: %s)", server_version, AGENT_VERSION)
         
         # Baixar nova versão
         download_url = f"{server}/api/agent/download"
-        r = requests.get(download_url, headers=headers, timeout=60, stream=True)
+        r = _get_session().get(download_url, headers=headers, timeout=60, stream=True)
         r.raise_for_status()
         
         # Salvar como arquivo temporário
         agent_path = Path(__file__)
         temp_path = agent_path.parent / f"agent_new_{server_version}.py"
         
+        # Manter o conteúdo em memória também, para validar sem reler o arquivo
+        data = bytearray()
         with open(temp_path, "wb") as f:
             for chunk in r.iter_content(chunk_size=64 * 1024):
                 if chunk:
                     f.write(chunk)
+                    data.extend(chunk)
         
-        # Verificar se o arquivo baixado é válido (compilação Python)
+        # Verificar se o arquivo baixado é válido (compilação Python, sem gerar .pyc)
         try:
-            import py_compile
-            py_compile.compile(str(temp_path), doraise=True)
+            compile(bytes(data), str(temp_path), "exec")
         except Exception as e:
-            print(f"[agent] Arquivo baixado inválido: {e}")
+            logger.error("Arquivo baixado inválido: %s", e)
             temp_path.unlink()
             return False
         
         # Fazer backup do arquivo atual
         backup_path = agent_path.parent / f"agent_backup_{AGENT_VERSION}.py"
         if agent_path.exists():
-            import shutil
             shutil.copy2(agent_path, backup_path)
         
         # Substituir arquivo atual
-        import shutil
         shutil.move(str(temp_path), str(agent_path))
         
-        print(f"[agent] Atualizado para versão {server_version}. Reiniciando...")
+        logger.info("Atualizado para versão %s. Reiniciando...", server_version)
         return True
         
     except Exception as e:
-        print(f"[agent] Erro ao verificar/baixar atualização: {e}")
+        logger.error("Erro ao verificar/baixar atualização: %s", e)
         return False
 
 
@@ -753,31 +1100,66 @@ def _state_path() -> Path:
     return Path(__file__).parent / "agent_state.json"
 
 
+def _state_key(p: Path) -> Optional[Tuple[int, int]]:
+    try:
+        st = p.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
 def _load_state() -> Dict[str, Any]:
+    global _STATE_CACHE
     p = _state_path()
-    if p.exists():
-        try:
-            data = json.loads(p.read_text(encoding="utf-8"))
-            return data if isinstance(data, dict) else {}
-        except Exception:
-            return {}
-    return {}
+    key = _state_key(p)
+    if key is None:
+        return {}
+    if _STATE_CACHE is not None and _STATE_CACHE[0] == key:
+        return copy.deepcopy(_STATE_CACHE[1])
+    try:
+        data = json.loads(p.read_text(encoding="utf-8"))
+        data = data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+    _STATE_CACHE = (key, data)
+    return copy.deepcopy(data)
 
 
 def _save_state(state: Dict[str, Any]) -> None:
+    """
+    Grava o estado de forma atômica (arquivo temporário + fsync + os.replace), para não
+    corromper o JSON numa queda de energia. Não regrava se o conteúdo não mudou.
+    """
+    global _STATE_CACHE, _STATE_HASH
+    p = _state_path()
     try:
-        _state_path().write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+        data = _dumps(state, pretty=True)
     except Exception:
-        pass
+        return
+    digest = hashlib.blake2b(data, digest_size=8).digest()
+    if digest == _STATE_HASH and _STATE_CACHE is not None and _STATE_CACHE[0] == _state_key(p):
+        return
+    tmp = p.with_name(p.name + ".tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, p)
+    except Exception:
+        return
+    _STATE_HASH = digest
+    key = _state_key(p)
+    _STATE_CACHE = (key, copy.deepcopy(state)) if key is not None else None
 
 
+@functools.lru_cache(maxsize=1)
 def load_or_create_agent_id() -> str:
     """
     Gera um agent_id único baseado no hostname da máquina.
     Isso garante que cada PC tenha um ID diferente, mesmo se os arquivos forem copiados.
+    Calculado uma vez por processo (hostname e ID não mudam durante a execução).
     """
-    import hashlib
-    
     # Usar hostname como base para gerar ID único por máquina
     hostname = get_host_name()
     
@@ -790,14 +1172,14 @@ def load_or_create_agent_id() -> str:
     if saved_hostname != hostname or not saved_agent_id:
         # Gerar ID único baseado no hostname + timestamp + random
         unique_string = f"{hostname}-{time.time()}-{uuid.uuid4()}"
-        agent_id = hashlib.sha256(unique_string.encode()).hexdigest()[:32]
+        agent_id = hashlib.blake2b(unique_string.encode(), digest_size=16).hexdigest()
         
         state = data if isinstance(data, dict) else {}
         state["agent_id"] = agent_id
         state["hostname"] = hostname
         _save_state(state)
         
-        print(f"[agent] Novo agent_id gerado para hostname '{hostname}': {agent_id}")
+        logger.info("Novo agent_id gerado para hostname '%s': %s", hostname, agent_id)
         return agent_id
     
     # Retornar agent_id existente para este hostname
@@ -807,73 +1189,260 @@ def load_or_create_agent_id() -> str:
 def register_agent(server: str, agent_id: str, host: str, token: Optional[str]) -> Dict[str, Any]:
     url = f"{server}/api/agents/register"
     try:
-        r = requests.post(url, json={"agent_id": agent_id, "host": host, "token": token}, timeout=10)
+        r = _get_session().post(url, json={"agent_id": agent_id, "host": host, "token": token}, timeout=10)
         if r.status_code == 200:
             return r.json() if r.headers.get("content-type", "").lower().startswith("application/json") else {"ok": False, "reason": "invalid_response"}
-        return {"ok": False, "reason": f"http_{r.status_code}", "detail": (r.text or "")[:200]}
+        return {
+            "ok": False,
+            "reason": f"http_{r.status_code}",
+            "detail": (r.text or "")[:200],
+            "transient": _is_transient_status(r.status_code),
+        }
     except Exception as e:
-        return {"ok": False, "reason": str(e)}
+        return {"ok": False, "reason": str(e), "transient": True}
 
 
-def fetch_server_config(server: str, site: str, token: Optional[str]) -> Optional[Dict[str, Any]]:
+def fetch_server_config(server: str, site: str, token: Optional[str], stale_ok: bool = True) -> Optional[Dict[str, Any]]:
+    """Busca a config do site no servidor, com cache de _SERVER_CFG_TTL_SEC por (server, site).
+    Com stale_ok, uma falha de rede/HTTP devolve a última config conhecida em vez de None.
+    """
+    key = (server, site)
+    cached = _SERVER_CFG_CACHE.get(key)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < _SERVER_CFG_TTL_SEC:
+        return cached[1]
+
     url = f"{server}/api/agents/{site}/config"
     headers = {"X-Agent-Token": token} if token else {}
     try:
-        r = requests.get(url, headers=headers, timeout=8)
+        r = _get_session().get(url, headers=headers, timeout=8)
         if r.status_code == 200:
-            return r.json()
+            js = r.json()
+            _SERVER_CFG_CACHE[key] = (now, js)
+            return js
         else:
-            print(f"[agent] config HTTP {r.status_code}: {r.text[:200]}")
-            return None
+            logger.warning("config HTTP %s: %s", r.status_code, r.text[:200])
     except Exception as e:
-        print(f"[agent] config error: {e}")
-        return None
+        logger.error("config error: %s", e)
+
+    if stale_ok and cached is not None:
+        logger.info("using cached config (%ss old)", int(now - cached[0]))
+        return cached[1]
+    return None
 
 
 def post_report(server: str, site: str, token: Optional[str], payload: Dict[str, Any]) -> bool:
+    status = _post_report_status(server, site, token, payload)
+    return status is not None and 200 <= status < 300
+
+
+def _post_report_status(server: str, site: str, token: Optional[str], payload: Dict[str, Any]) -> Optional[int]:
+    """Envia um relatório. Retorna o status HTTP, ou None se não conseguiu falar com o servidor."""
     url = f"{server}/api/agents/{site}/report"
     headers = {"Content-Type": "application/json"}
     if token:
         headers["X-Agent-Token"] = token
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=10)
-        if r.status_code == 200:
-            print(f"[agent] report ok: {r.json()}")
-            return True
-        else:
-            print(f"[agent] report HTTP {r.status_code}: {r.text[:200]}")
-            return False
+        r = _get_session().post(url, headers=headers, data=_dumps(payload), timeout=10)
     except Exception as e:
-        print(f"[agent] report error: {e}")
-        return False
+        logger.error("report error: %s", e)
+        return None
+    # Entrega decidida só pelo status: corpo não-JSON numa resposta 2xx não é falha de envio
+    if 200 <= r.status_code < 300:
+        logger.info("report ok: %s", r.text[:200])
+    else:
+        logger.warning("report HTTP %s: %s", r.status_code, r.text[:200])
+    return r.status_code
+
+
+def _is_transient_status(status: Optional[int]) -> bool:
+    """Falha que vale tentar de novo: sem resposta (None), 5xx, 408 ou 429."""
+    return status is None or status >= 500 or status in _TRANSIENT_HTTP_STATUSES
+
+
+def _send_reports(server: str, site: str, token: Optional[str], reports: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Envia os relatórios em ordem (pendentes mais antigos primeiro, o atual por último), pela mesma
+    conexão keep-alive. Para na primeira falha de rede/5xx/408/429 e devolve os que ainda faltam
+    enviar. Relatórios recusados com outro 4xx são descartados (reenviar não vai mudar a resposta).
+    """
+    for i, payload in enumerate(reports):
+        status = _post_report_status(server, site, token, payload)
+        if _is_transient_status(status):
+            return reports[i:]
+        if not 200 <= status < 300:
+            logger.warning("dropping report from %s (HTTP %s)", payload.get("timestamp"), status)
+    return []
+
+
+def _backoff_delay(failures: int, base_sec: float, max_sec: float) -> float:
+    """Atraso exponencial (base, 2x, 4x, ... até max_sec) + jitter de até 10s após `failures` falhas seguidas."""
+    return min(max_sec, base_sec * 2 ** max(0, failures - 1)) + random.uniform(0, 10)
+
+
+def _report_missing_password(c: Cam) -> Dict[str, Any]:
+    """Item de relatório para câmera sem senha NVR configurada (não há o que testar)."""
+    ip, name = c.ip, c.name
+    
+    logger.info("Testing camera: %s (%s)", name, ip)
+    logger.info("NVR password configured: No")
+    logger.error("ERROR: Camera %s has no NVR password configured", name)
+    return {
+        "name": name,
+        "ip": ip,
+        "status": "error",
+        "error": "NVR password not configured",
+        "stream_ok": False
+    }
+
+
+def _probe_camera_stream(c: Cam) -> Dict[str, Any]:
+    """Testa o stream RTSP de uma câmera (com senha NVR) via VLC e devolve o item do relatório."""
+    ip, name = c.ip, c.name
+    
+    logger.info("Testing camera: %s (%s)", name, ip)
+    logger.info("NVR password configured: Yes")
+    
+    # Testar stream RTSP via VLC
+    logger.info("Testing RTSP stream for %s...", name)
+    stream_ok, error_msg = test_camera_nvr_stream(ip, c.nvr_password, timeout_sec=10)
+    
+    if stream_ok:
+        logger.info("✓ Camera %s stream OK", name)
+    else:
+        logger.warning("✗ Camera %s stream FAILED: %s", name, error_msg)
+    
+    return {
+        "name": name,
+        "ip": ip,
+        "status": "ok" if stream_ok else "error",
+        "stream_ok": stream_ok,
+        "error": error_msg,
+        "nvr_password": "***"  # Não enviar senha no relatório
+    }
+
+
+def _test_cameras(cameras: List[Cam]) -> List[Dict[str, Any]]:
+    """
+    Testa todas as câmeras em paralelo (cada teste é I/O: subprocesso VLC + rede).
+    Câmeras sem senha NVR são resolvidas antes, sem ocupar thread do pool.
+    O relatório mantém a ordem da lista de câmeras.
+    """
+    reports: List[Optional[Dict[str, Any]]] = [None] * len(cameras)
+    to_stream: List[int] = []
+    for i, c in enumerate(cameras):
+        if c.nvr_password:
+            to_stream.append(i)
+        else:
+            reports[i] = _report_missing_password(c)
+    
+    if to_stream:
+        try:
+            max_workers = int(os.getenv("AGENT_CAMERA_WORKERS", "8"))
+        except Exception:
+            max_workers = 8
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(to_stream)))) as ex:
+            for i, report in zip(to_stream, ex.map(_probe_camera_stream, [cameras[i] for i in to_stream])):
+                reports[i] = report
+    
+    return [r for r in reports if r is not None]
+
+
+def _run_bandwidth_tests(
+    run_inet: bool, st_args: Optional[Tuple[str, int, int, Optional[str]]]
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Roda o speedtest de internet e o do servidor um depois do outro: em paralelo os dois
+    dividem o mesmo link e cada um mede cerca de metade da banda real.
+    st_args = (server, download_bytes, upload_bytes, token) ou None para pular.
+    """
+    inet = internet_speedtest() if run_inet else None
+    st = speedtest(*st_args) if st_args is not None else None
+    return inet, st
 
 
 def run_once(cfg: Dict[str, Any]) -> None:
+    asyncio.run(run_once_async(cfg))
+
+
+async def run_once_async(cfg: Dict[str, Any]) -> None:
+    """
+    Um ciclo do agente. Depois do registro, config do servidor, testes de rede e câmeras
+    rodam em paralelo; chamadas bloqueantes vão para threads via asyncio.to_thread.
+    Os testes de banda rodam em sequência, depois dos pings (ver _run_bandwidth_tests).
+    """
     server: str = cfg["server"]
     token: Optional[str] = cfg.get("token")
+    # Instante lógico do ciclo: decisões de cache/backoff, timestamps do estado e do relatório
+    now = time.time()
+    now_iso = datetime.fromtimestamp(now, tz=timezone.utc).isoformat()
+
+    # Pool único para todas as etapas bloqueantes do ciclo. O executor padrão do asyncio tem
+    # min(32, CPUs + 4) threads: num PC de 2 núcleos, pings/HTTP/DNS/speedtests/câmeras ficariam
+    # em fila atrás dos speedtests. asyncio.run() encerra este executor no fim do ciclo.
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=_CYCLE_EXECUTOR_WORKERS, thread_name_prefix="agent")
+    )
 
     host = get_host_name()
     agent_id = load_or_create_agent_id()
-    reg = register_agent(server, agent_id, host, token)
-    if not bool(reg.get("ok")):
-        print(f"[agent] register denied: {reg}")
-        return
-    site = str(reg.get("site") or "").strip()
-    if not site:
-        print(f"[agent] register missing site: {reg}")
+    # Estado carregado uma vez por ciclo; gravado uma vez no final, só se mudou
+    state = _load_state()
+    dirty = False
+    # Descartar chaves de versões antigas (ex.: cache de MAC por câmera, que crescia sem limite)
+    for key in _LEGACY_STATE_KEYS:
+        if key in state:
+            del state[key]
+            dirty = True
+
+    reg = await asyncio.to_thread(register_agent, server, agent_id, host, token)
+    if bool(reg.get("ok")):
+        site = str(reg.get("site") or "").strip()
+        if not site:
+            logger.error("register missing site: %s", reg)
+            return
+        if state.get("last_site") != site:
+            state["last_site"] = site
+            dirty = True
+    elif reg.get("transient") and state.get("last_site"):
+        # Servidor fora do ar: medir mesmo assim e deixar o relatório na fila (pending_reports)
+        site = str(state["last_site"])
+        logger.warning("register failed (%s), reporting for last known site %s", reg.get("reason"), site)
+    else:
+        logger.error("register %s: %s", "failed" if reg.get("transient") else "denied", reg)
         return
 
+    # Disparar já o que não depende da config do servidor
+    conf_task = asyncio.create_task(asyncio.to_thread(fetch_server_config, server, site, token))
+    # 2) Testes de rede
+    net_task = asyncio.create_task(test_network())
+
+    # 2.0) Internet speedtest (opcional) - cache
+    inet_enabled = os.getenv("AGENT_INET_SPEEDTEST", "1").strip().lower() in ("1", "true", "yes")
+    inet_interval_sec = int(os.getenv("AGENT_INET_SPEEDTEST_INTERVAL_SEC", "300"))
+    last_inet_at = state.get("last_inet_speedtest_at")
+    last_inet = state.get("last_inet_speedtest") if isinstance(state.get("last_inet_speedtest"), dict) else None
+    run_inet = False
+    try:
+        next_inet_at = state.get("next_inet_attempt_at")
+        # Se a última tentativa deu erro, tentar de novo só depois do backoff.
+        if isinstance(last_inet, dict) and last_inet.get("inet_error"):
+            run_inet = not isinstance(next_inet_at, (int, float)) or now >= float(next_inet_at)
+        elif not isinstance(last_inet_at, (int, float)):
+            run_inet = True
+        else:
+            run_inet = (now - float(last_inet_at)) >= float(max(30, inet_interval_sec))
+    except Exception:
+        run_inet = True
+
     # 1) Obter lista de câmeras do servidor (ou fallback para config local)
-    conf = fetch_server_config(server, site, token)
-    print(f"[agent] Server config received: {conf}")
-    cameras: List[Dict[str, Any]] = []
+    conf = await conf_task
+    logger.debug("Server config received: %s", conf)
     speed_enabled = bool(cfg.get("speedtest"))
     # Aumentar tamanho padrão para melhor precisão (5MB download, 2MB upload)
     speed_dl = int(cfg.get("speed_download_bytes", 5 * 1024 * 1024))
     speed_ul = int(cfg.get("speed_upload_bytes", 2 * 1024 * 1024))
     speedtest_interval_sec = int(os.getenv("AGENT_SPEEDTEST_INTERVAL_SEC", "60"))
-    inet_enabled = os.getenv("AGENT_INET_SPEEDTEST", "1").strip().lower() in ("1", "true", "yes")
-    inet_interval_sec = int(os.getenv("AGENT_INET_SPEEDTEST_INTERVAL_SEC", "300"))
     if conf and isinstance(conf, dict) and conf.get("speedtest_interval_sec") is not None:
         try:
             speedtest_interval_sec = int(conf.get("speedtest_interval_sec"))
@@ -898,135 +1467,110 @@ def run_once(cfg: Dict[str, Any]) -> None:
             except Exception:
                 pass
     if conf and isinstance(conf.get("cameras"), list):
-        for c in conf["cameras"]:
-            if isinstance(c, dict) and c.get("ip"):
-                cameras.append({
-                    "name": c.get("name"), 
-                    "ip": c.get("ip"),
-                    "nvr_password": c.get("nvr_password")
-                })
+        raw_cameras = conf["cameras"]
     else:
         # fallback local
-        for c in cfg.get("cameras", []):
-            if isinstance(c, dict) and c.get("ip"):
-                cameras.append({
-                    "name": c.get("name"), 
-                    "ip": c.get("ip"),
-                    "nvr_password": c.get("nvr_password")
-                })
-
-    # 2) Testes de rede
-    net = test_network()
-
-    # 2.0) Internet speedtest (opcional) - cache
-    state = _load_state()
-    last_inet_at = state.get("last_inet_speedtest_at")
-    last_inet = state.get("last_inet_speedtest") if isinstance(state.get("last_inet_speedtest"), dict) else None
-    run_inet = False
-    try:
-        now = time.time()
-        # Se a última tentativa deu erro, tentar novamente imediatamente.
-        if isinstance(last_inet, dict) and last_inet.get("inet_error"):
-            run_inet = True
-        elif not isinstance(last_inet_at, (int, float)):
-            run_inet = True
-        else:
-            run_inet = (now - float(last_inet_at)) >= float(max(30, inet_interval_sec))
-    except Exception:
-        run_inet = True
-
-    if inet_enabled and run_inet:
-        inet = internet_speedtest()
-        net.update(inet)
-        state["last_inet_speedtest"] = inet
-        # Só cacheia o timestamp quando não houve erro, para tentar novamente no próximo ciclo.
-        if not inet.get("inet_error"):
-            state["last_inet_speedtest_at"] = time.time()
-        _save_state(state)
-    elif isinstance(last_inet, dict):
-        net.update(last_inet)
+        raw_cameras = cfg.get("cameras", [])
+    cameras: List[Cam] = [
+        Cam(c.get("name"), c["ip"], c.get("nvr_password"))
+        for c in raw_cameras
+        if isinstance(c, dict) and c.get("ip")
+    ]
 
     # 2.1) Speedtest (opcional) - cache para não rodar a cada ciclo
-    state = _load_state()
     last_st_at = state.get("last_speedtest_at")
     last_st = state.get("last_speedtest") if isinstance(state.get("last_speedtest"), dict) else None
     run_st = False
     try:
-        now = time.time()
-        if not isinstance(last_st_at, (int, float)):
+        next_st_at = state.get("next_speedtest_attempt_at")
+        if isinstance(next_st_at, (int, float)) and now < float(next_st_at):
+            run_st = False
+        elif not isinstance(last_st_at, (int, float)):
             run_st = True
         else:
             run_st = (now - float(last_st_at)) >= float(max(5, speedtest_interval_sec))
     except Exception:
         run_st = True
 
-    if speed_enabled and run_st:
-        st = speedtest(server, speed_dl, speed_ul, token)
+    # 3) Testar câmeras via NVR usando VLC (em paralelo com os testes de rede)
+    cam_task = asyncio.create_task(asyncio.to_thread(_test_cameras, cameras))
+
+    # Latência medida antes dos testes de banda: com o link saturado o ping sai inflado
+    net = await net_task
+    inet, st = await asyncio.to_thread(
+        _run_bandwidth_tests,
+        inet_enabled and run_inet,
+        (server, speed_dl, speed_ul, token) if speed_enabled and run_st else None,
+    )
+
+    if inet is not None:
+        net.update(inet)
+        state["last_inet_speedtest"] = inet
+        # Só cacheia o timestamp quando não houve erro; em erro, agenda nova tentativa com backoff.
+        if not inet.get("inet_error"):
+            state["last_inet_speedtest_at"] = now
+            state["inet_failure_count"] = 0
+            state.pop("next_inet_attempt_at", None)
+        else:
+            failures = int(state.get("inet_failure_count") or 0) + 1
+            state["inet_failure_count"] = failures
+            state["next_inet_attempt_at"] = now + _backoff_delay(failures, 30, max(30, inet_interval_sec))
+        dirty = True
+    elif isinstance(last_inet, dict):
+        net.update(last_inet)
+
+    if st is not None:
         net.update(st)
-        state["last_speedtest_at"] = time.time()
+        state["last_speedtest_at"] = now
         state["last_speedtest"] = st
-        _save_state(state)
+        if st.get("download_mbps") is None and st.get("upload_mbps") is None:
+            failures = int(state.get("speedtest_failure_count") or 0) + 1
+            state["speedtest_failure_count"] = failures
+            base = max(5, speedtest_interval_sec)
+            state["next_speedtest_attempt_at"] = now + _backoff_delay(failures, base, 8 * base)
+        else:
+            state["speedtest_failure_count"] = 0
+            state.pop("next_speedtest_attempt_at", None)
+        dirty = True
     elif isinstance(last_st, dict):
         net.update(last_st)
 
-    # 3) Testar câmeras via NVR usando VLC
-    cam_reports: List[Dict[str, Any]] = []
-    
-    for c in cameras:
-        ip = c.get("ip")
-        name = c.get("name")
-        nvr_password = c.get("nvr_password", "")
-        
-        print(f"[agent] Testing camera: {name} ({ip})")
-        print(f"[agent] NVR password configured: {'Yes' if nvr_password else 'No'}")
-        
-        if not nvr_password:
-            # Se não tem senha NVR, reportar erro
-            print(f"[agent] ERROR: Camera {name} has no NVR password configured")
-            cam_reports.append({
-                "name": name,
-                "ip": ip,
-                "status": "error",
-                "error": "NVR password not configured",
-                "stream_ok": False
-            })
-            continue
-        
-        # Testar stream RTSP via VLC
-        print(f"[agent] Testing RTSP stream for {name}...")
-        stream_ok, error_msg = test_camera_nvr_stream(ip, nvr_password, timeout_sec=10)
-        
-        if stream_ok:
-            print(f"[agent] ✓ Camera {name} stream OK")
-        else:
-            print(f"[agent] ✗ Camera {name} stream FAILED: {error_msg}")
-        
-        cam_reports.append({
-            "name": name,
-            "ip": ip,
-            "status": "ok" if stream_ok else "error",
-            "stream_ok": stream_ok,
-            "error": error_msg,
-            "nvr_password": "***"  # Não enviar senha no relatório
-        })
-    
-    # Não precisa mais de cache de MAC para NVR
+    cam_reports = await cam_task
 
     # 4) Montar payload
     payload = {
         "site": site,
         "host": host,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": now_iso,
         "network": net,
         "cameras": cam_reports,
         "agent": {"version": AGENT_VERSION, "interval_sec": cfg.get("interval_sec", DEFAULT_INTERVAL)}
     }
 
-    # 5) Enviar
-    post_report(server, site, token, payload)
+    # 5) Enviar, junto com relatórios que não puderam ser entregues em ciclos anteriores
+    pending = state.get("pending_reports") if isinstance(state.get("pending_reports"), list) else []
+    if pending:
+        logger.info("sending %s pending report(s)", len(pending))
+    unsent = await asyncio.to_thread(_send_reports, server, site, token, pending + [payload])
+    unsent = unsent[-_MAX_PENDING_REPORTS:]
+    if unsent:
+        state["pending_reports"] = unsent
+        dirty = True
+    elif "pending_reports" in state:
+        del state["pending_reports"]
+        dirty = True
+
+    if dirty:
+        _save_state(state)
 
 
 def main() -> None:
+    level = os.getenv("AGENT_LOG_LEVEL", "INFO").strip().upper()
+    logging.basicConfig(
+        level=level if isinstance(logging.getLevelName(level), int) else logging.INFO,
+        stream=sys.stdout,
+        format="[%(name)s] %(message)s",
+    )
     cfg = load_agent_config()
     loop = cfg.get("loop", False)
     interval_sec = cfg.get("interval_sec", DEFAULT_INTERVAL)
@@ -1035,28 +1579,43 @@ def main() -> None:
     
     # Verificar atualização na inicialização
     update_check_interval = 300  # 5 minutos
-    last_update_check = 0
+    last_update_check: Optional[float] = None  # time.monotonic() da última verificação
     
     if loop:
         while True:
+            cycle_start = time.monotonic()
+            # Recarregar config a cada ciclo (volta do cache se agent.json não mudou).
+            # Se o agent.json editado estiver inválido, seguir com a última config boa.
+            try:
+                new_cfg = load_agent_config(strict=True)
+                new_interval = int(new_cfg.get("interval_sec", DEFAULT_INTERVAL))
+                cfg, interval_sec = new_cfg, new_interval
+                server = cfg.get("server", "")
+                token = cfg.get("token")
+            except Exception as e:
+                logger.error("invalid agent.json, keeping previous config: %s", e)
             try:
                 # Verificar atualização periodicamente
-                now = time.time()
-                if now - last_update_check >= update_check_interval:
+                now = time.monotonic()
+                if last_update_check is None or now - last_update_check >= update_check_interval:
                     if check_and_update(server, token):
                         # Atualização baixada, reiniciar processo
-                        print("[agent] Reiniciando após atualização...")
+                        logger.info("Reiniciando após atualização...")
                         os.execv(sys.executable, [sys.executable] + sys.argv)
                     last_update_check = now
                 
                 run_once(cfg)
             except Exception as e:
-                print(f"[agent] error in run_once: {e}")
-            time.sleep(interval_sec)
+                logger.error("error in run_once: %s", e)
+            # Dormir só o que falta para completar o intervalo (sem acumular deriva)
+            elapsed = time.monotonic() - cycle_start
+            if elapsed > interval_sec:
+                logger.warning("cycle took %.1fs (interval %ss)", elapsed, interval_sec)
+            time.sleep(max(0.0, interval_sec - elapsed))
     else:
         # Modo single-run: verificar atualização antes de executar
         if check_and_update(server, token):
-            print("[agent] Atualização aplicada. Execute novamente para usar nova versão.")
+            logger.info("Atualização aplicada. Execute novamente para usar nova versão.")
         else:
             run_once(cfg)
 